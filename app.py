@@ -1,80 +1,396 @@
 import gradio as gr
-import requests
-import base64
+import httpx
+import asyncio
+import pybase64
 import uuid
 import os
+import gzip
+import logging
+import functools
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
-import json
+import orjson
+import ijson
+
+logger = logging.getLogger(__name__)
+DEBUG = bool(os.getenv("DEBUG"))
+if DEBUG:
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+
+# libjpeg-turbo is optional; without the native library we fall back
+# to Pillow's codec.
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    TJ = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    TJ = None
 
 # ---------- Helper functions ----------
 
+JPEG_MAGIC = b"\xff\xd8\xff"
+
+# Longest edge sent to the model; larger uploads are downscaled
+H_MAX = 1024
+JPEG_QUALITY = 85
+
+# Uploads above this are rejected before any decoding
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+def _tj_scaling_factor(width, height):
+    """Smallest libjpeg-turbo DCT scale that keeps the long edge >= H_MAX."""
+    long_edge = max(width, height)
+    fits = [f for f in TJ.scaling_factors if long_edge * f[0] / f[1] >= H_MAX]
+    return min(fits, key=lambda f: f[0] / f[1])
+
+def _encode_jpeg(img_file):
+    """Return the JPEG bytes to send for an uploaded file.
+
+    JPEG uploads that already fit within H_MAX are passed through
+    untouched; anything else is downscaled and re-encoded to JPEG.
+    """
+    with open(img_file, "rb") as f:
+        raw = f.read()
+    image = Image.open(BytesIO(raw))
+    oversized = max(image.size) > H_MAX
+    if raw[:3] == JPEG_MAGIC and not oversized:
+        return raw
+
+    if TJ is not None and raw[:3] == JPEG_MAGIC:
+        # Decode at a reduced DCT scale straight to RGB
+        scale = _tj_scaling_factor(*image.size)
+        image = Image.fromarray(TJ.decode(raw, pixel_format=TJPF_RGB, scaling_factor=scale))
+    else:
+        # Let libjpeg decode at a reduced DCT scale (no-op for other formats)
+        image.draft("RGB", (H_MAX, H_MAX))
+        image.load()
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+    if oversized:
+        image.thumbnail((H_MAX, H_MAX), Image.LANCZOS)
+    if TJ is not None:
+        return TJ.encode(np.asarray(image), quality=JPEG_QUALITY, pixel_format=TJPF_RGB)
+    buffered = BytesIO()
+    # optimize=True only pays off for the large, downscaled images
+    image.save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=oversized)
+    return buffered.getbuffer()
+
+# Re-clicks with the same uploads reuse earlier results; the stat
+# fields in the key invalidate an entry if the file changes.
+@functools.lru_cache(maxsize=32)
+def _jpeg_cached(img_file, size, mtime_ns):
+    return _encode_jpeg(img_file)
+
+@functools.lru_cache(maxsize=32)
+def _base64_cached(img_file, size, mtime_ns):
+    # ASCII bytes, spliced into the JSON body as-is
+    return pybase64.b64encode(_jpeg_cached(img_file, size, mtime_ns))
+
+def _cache_key(img_file):
+    """Return the (path, size, mtime) cache key, rejecting oversized uploads."""
+    st = os.stat(img_file)
+    if st.st_size > MAX_UPLOAD_BYTES:
+        raise ValueError(f"image too large ({st.st_size / 2**20:.1f} MB, max {MAX_UPLOAD_BYTES / 2**20:.0f} MB)")
+    return img_file, st.st_size, st.st_mtime_ns
+
+def image_to_jpeg(img_file):
+    """Return the JPEG bytes to send for an uploaded file (cached)."""
+    return _jpeg_cached(*_cache_key(img_file))
+
 def image_to_base64(img_file):
-    """Convert uploaded file to base64 (JPEG only)."""
-    image = Image.open(img_file).convert("RGB")
+    """Convert uploaded file to base64 ASCII bytes (JPEG only, cached)."""
+    return _base64_cached(*_cache_key(img_file))
+
+# Pillow, pybase64 and gzip release the GIL, so threads are enough to
+# keep both images (and concurrent users) encoding in parallel.
+ENCODE_POOL = ThreadPoolExecutor(max_workers=max(2, os.cpu_count() or 1), thread_name_prefix="encode")
+
+async def run_in_pool(fn, *args):
+    """Run CPU-bound work on the encode pool without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(ENCODE_POOL, fn, *args)
+
+# Generated images are written straight into Gradio's cache directory
+# (GRADIO_TEMP_DIR, which may point at a tmpfs) so Gradio serves them
+# without copying, and delete_cache (see gr.Blocks below) is the only
+# expiry. That cache also holds the uploads, so the max age has to
+# outlast a user re-clicking Generate with the same images.
+CACHE_SWEEP = 10 * 60
+CACHE_TTL = 60 * 60
+
+def new_output():
+    """Create a unique output JPEG file; return (fd, filename)."""
+    os.makedirs(demo.GRADIO_CACHE, exist_ok=True)
+    return tempfile.mkstemp(prefix="generated_", suffix=".jpeg", dir=demo.GRADIO_CACHE)
+
+def _transcode_to_jpeg(img_bytes):
+    img = Image.open(BytesIO(img_bytes)).convert("RGB")
     buffered = BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    img.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+def save_jpeg(img_bytes, mime_type="image/jpeg"):
+    """Save image bytes as a unique JPEG file.
 
-def save_base64_to_jpeg(b64_data):
+    JPEG data is written as-is; other formats are transcoded first.
+    """
+    if mime_type != "image/jpeg":
+        img_bytes = _transcode_to_jpeg(img_bytes)
+    fd, filename = new_output()
+    with open(fd, "wb") as f:
+        f.write(img_bytes)
+    return filename
+
+def transcode_file_to_jpeg(filename):
+    """Re-encode a saved non-JPEG image to JPEG in place."""
+    with open(filename, "rb") as f:
+        img_bytes = _transcode_to_jpeg(f.read())
+    with open(filename, "wb") as f:
+        f.write(img_bytes)
+
+def save_base64_to_jpeg(b64_data, mime_type="image/jpeg"):
     """Decode base64 image and save as unique JPEG file."""
-    img_bytes = base64.b64decode(b64_data)
-    img = Image.open(BytesIO(img_bytes)).convert("RGB")
-    filename = f"generated_{uuid.uuid4().hex}.jpeg"
-    img.save(filename, format="JPEG")
+    return save_jpeg(pybase64.b64decode(b64_data, validate=False), mime_type)
+
+def to_json(obj):
+    """Pretty-print an object as indented JSON for the metadata box."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode("utf-8")
+
+# ---------- HTTP client ----------
+
+# Caps concurrent outbound Gemini calls
+API_SEMAPHORE = asyncio.Semaphore(5)
+
+# Generations admitted at once (running or waiting for the semaphore);
+# beyond this callers are told the server is busy
+PENDING = asyncio.Queue(maxsize=32)
+
+# Keep-alive pool limits and (connect, read) timeouts in seconds
+POOL_MAXSIZE = 16
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 120
+
+# HTTP/2 lets concurrent generations share one TLS connection
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE),
+)
+
+async def download_to_jpeg(client, url, mime_type="image/jpeg"):
+    """Stream a download straight into a new output file; return its path.
+
+    JPEG data is written as it arrives; other formats are transcoded
+    once the download completes.
+    """
+    fd, filename = new_output()
+    try:
+        with open(fd, "wb") as f:
+            async with API_SEMAPHORE:
+                async with client.stream("GET", url) as r:
+                    r.raise_for_status()
+                    async for chunk in r.aiter_bytes():
+                        f.write(chunk)
+        if mime_type != "image/jpeg":
+            await run_in_pool(transcode_file_to_jpeg, filename)
+    except BaseException:
+        os.unlink(filename)
+        raise
     return filename
 
+# Read size for the streaming JSON parser; yajl handles a long string
+# far faster in large reads than in many small ones
+PARSE_CHUNK = 1 << 20
+
+async def _json_events(resp):
+    """Yield ijson (prefix, event, value) tuples from a streamed response."""
+    events = ijson.sendable_list()
+    # Floats instead of Decimal so copied subtrees stay JSON-serializable
+    parser = ijson.parse_coro(events, use_float=True)
+    async for chunk in resp.aiter_bytes(PARSE_CHUNK):
+        parser.send(chunk)
+        for item in events:
+            yield item
+        del events[:]
+    parser.close()
+    for item in events:
+        yield item
+
+RESPONSE_PART = "candidates.item.content.parts.item"
+PROMPT_FEEDBACK = "promptFeedback"
+SAFETY_RATINGS = "candidates.item.safetyRatings"
+
+async def parse_response(resp):
+    """Stream-parse a generateContent response, keeping only what the UI uses.
+
+    Returns a dict shaped like the response: the first candidate's parts
+    (up to the first image), finishReason and safetyRatings, plus
+    promptFeedback, modelVersion and responseId. The feedback fields are
+    kept so a blocked request still explains why no image came back.
+    """
+    parts = []
+    first = {"content": {"parts": parts}}
+    data = {"candidates": [first]}
+    candidate = -1
+    builder = None
+    built = None
+    have_image = False
+    async for prefix, event, value in _json_events(resp):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == built and event in ("end_map", "end_array"):
+                if built == RESPONSE_PART:
+                    parts.append(builder.value)
+                    have_image = "inlineData" in builder.value or "fileData" in builder.value
+                elif built == PROMPT_FEEDBACK:
+                    data[PROMPT_FEEDBACK] = builder.value
+                else:
+                    first["safetyRatings"] = builder.value
+                builder = None
+            continue
+
+        # Subtree to copy verbatim, if this event opens one
+        start = None
+        if prefix in ("modelVersion", "responseId"):
+            data[prefix] = value
+        elif prefix == PROMPT_FEEDBACK and event == "start_map":
+            start = prefix
+        elif prefix == "candidates.item" and event == "start_map":
+            candidate += 1
+        elif candidate != 0:
+            continue
+        elif prefix == "candidates.item.finishReason":
+            first["finishReason"] = value
+        elif prefix == SAFETY_RATINGS and event == "start_array":
+            start = prefix
+        elif prefix == RESPONSE_PART and event == "start_map" and not have_image:
+            start = prefix
+        if start is not None:
+            built = start
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+    return data
+
+UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files"
+
+# Images above this size go through the Files API instead of inline base64
+INLINE_MAX_BYTES = 1_000_000
+
+# Uploaded files expire server-side after 48h; reuse a URI for less than
+# that so re-clicks with the same image skip the upload.
+FILE_URI_TTL = 24 * 60 * 60
+_file_uris = {}
+
+async def upload_file(client, api_key, data, mime_type="image/jpeg"):
+    """Upload raw bytes with the Files API resumable protocol; return the file URI."""
+    start_headers = {
+        "x-goog-api-key": api_key,
+        "X-Goog-Upload-Protocol": "resumable",
+        "X-Goog-Upload-Command": "start",
+        "X-Goog-Upload-Header-Content-Length": str(len(data)),
+        "X-Goog-Upload-Header-Content-Type": mime_type,
+        "Content-Type": "application/json",
+    }
+    body = orjson.dumps({"file": {"display_name": f"upload_{uuid.uuid4().hex}"}})
+    r = await client.post(UPLOAD_URL, content=body, headers=start_headers)
+    r.raise_for_status()
+    upload_url = r.headers["X-Goog-Upload-URL"]
+
+    upload_headers = {
+        "X-Goog-Upload-Offset": "0",
+        "X-Goog-Upload-Command": "upload, finalize",
+    }
+    r = await client.post(upload_url, content=bytes(data), headers=upload_headers)
+    r.raise_for_status()
+    return orjson.loads(r.content)["file"]["uri"]
+
+# The request body never changes shape, so it is assembled from byte
+# templates. Base64 output needs no JSON escaping and is spliced in as-is.
+REQUEST_TEMPLATE = b'{"contents":[{"role":"user","parts":[%s]}]}'
+INLINE_PART_TEMPLATE = b'{"inlineData":{"mimeType":"image/jpeg","data":"%s"}}'
+
+async def image_part(client, api_key, img_file):
+    """Build the serialized request part for one upload.
+
+    Small images are inlined as base64, larger ones are uploaded first.
+    """
+    jpeg = await run_in_pool(image_to_jpeg, img_file)
+    if len(jpeg) > INLINE_MAX_BYTES:
+        # Files belong to the key's project; only a digest of it is kept
+        key = (hashlib.sha256(api_key.encode()).digest(), *_cache_key(img_file))
+        now = time.monotonic()
+        file_uri, expires = _file_uris.get(key, (None, 0))
+        if expires <= now:
+            async with API_SEMAPHORE:
+                file_uri = await upload_file(client, api_key, jpeg)
+            for k in [k for k, (_, exp) in _file_uris.items() if exp <= now]:
+                del _file_uris[k]
+            _file_uris[key] = (file_uri, now + FILE_URI_TTL)
+        return orjson.dumps({"fileData": {"mimeType": "image/jpeg", "fileUri": file_uri}})
+    data = await run_in_pool(image_to_base64, img_file)
+    return INLINE_PART_TEMPLATE % data
+
 # ---------- Main API call ----------
 
-def gemini_generate(api_key, prompt, influencer_img, product_img):
+async def gemini_generate(api_key, prompt, influencer_img, product_img):
     if not api_key:
-        return "❌ Error: API key required", None, "", "{}"
+        return "❌ Error: API key required", None, None, "{}"
 
     try:
-        # Convert both images to base64
-        influencer_b64 = image_to_base64(influencer_img)
-        product_b64 = image_to_base64(product_img)
+        PENDING.put_nowait(None)
+    except asyncio.QueueFull:
+        return "⏳ Server busy, please try again in a moment", None, None, "{}"
+    try:
+        return await _generate(api_key, prompt, influencer_img, product_img)
+    finally:
+        PENDING.get_nowait()
+
+async def _generate(api_key, prompt, influencer_img, product_img):
+    try:
+        # Prepare both images concurrently; small ones go inline,
+        # large ones via the Files API
+        influencer_part, product_part = await asyncio.gather(
+            image_part(CLIENT, api_key, influencer_img),
+            image_part(CLIENT, api_key, product_img),
+        )
 
         # Build correct payload
-        payload = {
-            "contents": [
-                {
-                    "role": "user",
-                    "parts": [
-                        {"text": prompt},
-                        {
-                            "inlineData": {
-                                "mimeType": "image/jpeg",
-                                "data": influencer_b64
-                            }
-                        },
-                        {
-                            "inlineData": {
-                                "mimeType": "image/jpeg",
-                                "data": product_b64
-                            }
-                        }
-                    ]
-                }
-            ]
-        }
+        parts = b",".join([orjson.dumps({"text": prompt}), influencer_part, product_part])
+        payload = REQUEST_TEMPLATE % parts
 
         url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-image-preview:generateContent"
-        headers = {"Content-Type": "application/json", "x-goog-api-key": api_key}
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+            "x-goog-api-key": api_key,
+        }
+        # Level 1 keeps the CPU cost low; base64 still shrinks noticeably
+        body = await run_in_pool(gzip.compress, payload, 1)
 
         # Send request
-        resp = requests.post(url, headers=headers, json=payload)
-        print("HTTP status:", resp.status_code)
-        print("Response snippet:", resp.text[:1000]) # debug
-
-        if resp.status_code != 200:
-            return f"❌ API Error {resp.status_code}", None, "", json.dumps(resp.json(), indent=2)
+        async with API_SEMAPHORE:
+            async with CLIENT.stream("POST", url, content=body, headers=headers) as resp:
+                status_code = resp.status_code
+                if status_code != 200:
+                    content = await resp.aread()
+                else:
+                    data = await parse_response(resp)
+        if DEBUG:
+            logger.debug("HTTP status: %s", status_code)
 
-        data = resp.json()
+        if status_code != 200:
+            if DEBUG:
+                logger.debug("Response snippet: %s", content[:1000].decode("utf-8", "replace"))
+            return f"❌ API Error {status_code}", None, None, to_json(orjson.loads(content))
 
         # Extract image result
         parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
         img_b64 = None
+        filename = None
         source_used = None
         mime_type = None
 
@@ -87,18 +403,16 @@ def gemini_generate(api_key, prompt, influencer_img, product_img):
             elif "fileData" in part:
                 file_uri = part["fileData"]["fileUri"]
                 mime_type = part["fileData"].get("mimeType", "image/jpeg")
-                r = requests.get(file_uri)
-                img_b64 = base64.b64encode(r.content).decode("utf-8")
+                filename = await download_to_jpeg(CLIENT, file_uri, mime_type)
                 source_used = "fileData"
                 break
 
-        if not img_b64:
-            return "⚠️ No image found in response", None, "", json.dumps(data, indent=2)
+        if not img_b64 and not filename:
+            return "⚠️ No image found in response", None, None, to_json(data)
 
-        # Save as JPEG
-        filename = save_base64_to_jpeg(img_b64)
-        with open(filename, "rb") as f:
-            final_b64 = base64.b64encode(f.read()).decode("utf-8")
+        # Save as JPEG (fileData was already written while downloading)
+        if filename is None:
+            filename = await run_in_pool(save_base64_to_jpeg, img_b64, mime_type)
 
         # Public URL (works in Colab/Gradio)
         final_url = f"/file={filename}"
@@ -112,14 +426,17 @@ def gemini_generate(api_key, prompt, influencer_img, product_img):
             "finalImage": final_url
         }
 
-        return "✅ Success", filename, final_b64, json.dumps(metadata, indent=2)
+        return "✅ Success", filename, filename, to_json(metadata)
 
     except Exception as e:
-        return f"❌ Exception: {str(e)}", None, "", "{}"
+        return f"❌ Exception: {str(e)}", None, None, "{}"
 
 # ---------- Gradio UI ----------
 
-with gr.Blocks(css=".gradio-container {max-width: 900px; margin: auto;}") as demo:
+with gr.Blocks(
+    css=".gradio-container {max-width: 900px; margin: auto;}",
+    delete_cache=(CACHE_SWEEP, CACHE_TTL),
+) as demo:
     gr.Markdown("## Gemini Image Preview Demo (Influencer + Product)")
 
     with gr.Row():
@@ -137,14 +454,16 @@ with gr.Blocks(css=".gradio-container {max-width: 900px; margin: auto;}") as dem
     with gr.Row():
         output_img = gr.Image(label="Preview (JPEG)")
     with gr.Row():
-        output_b64 = gr.Textbox(label="Base64 (JPEG)", lines=6)
+        output_file = gr.File(label="Download JPEG")
     with gr.Row():
         metadata = gr.Textbox(label="Metadata", lines=8)
 
     generate_btn.click(
         gemini_generate,
         inputs=[api_key, prompt, influencer, product],
-        outputs=[status, output_img, output_b64, metadata]
+        outputs=[status, output_img, output_file, metadata],
+        # Outbound concurrency is bounded by API_SEMAPHORE and PENDING
+        concurrency_limit=None
     )
 
 if __name__ == "__main__":